@@ -0,0 +1,146 @@
+import sys
+import numpy as np
+
+from TreeStruct import Nstates
+import Mk2Like
+
+# Exact marginal likelihood for the Mk2 model with one rate fixed at 0 and an
+#   exponential prior on the other (free) rate q.
+#
+# With one rate at 0, along a branch of (in-slice) length t, with e = exp(-q*t):
+#   parent in the free state  -> daughter free: e,  daughter fixed: 1 - e
+#   parent in the fixed state -> daughter fixed: 1
+# So the cl of the fixed state is a constant (0 or 1) at every node, and the cl
+# of the free state is a finite sum of terms c * exp(-q*tau).  Each term then
+# integrates against the prior to c * prior_rate / (prior_rate + tau).
+
+def LogMargLik(root, which_fixed, time_slice, prior_rate, \
+               root_prior="condlike", max_terms=20000, max_cond=1e8):
+    '''
+    Get the log marginal likelihood of the tree and states, integrated over
+      the exponential prior on the free rate, with no quadrature.
+    which_fixed is the index of the rate fixed at 0 (as in Mk2Like.NegLogL).
+    Returns None if the likelihood can't be expanded within max_terms terms,
+      or if cancellation between terms would lose too much precision (the
+      sum is worse conditioned than max_cond); use numerical integration then.
+    '''
+
+    free = 1 - which_fixed
+    ans = _GetTreePoly(root, which_fixed, time_slice, max_terms)
+    if ans == None:
+        return None
+    ((exps, coefs), cl_fixed) = ans
+
+    ### combine at the root: like = sum over states of root_p * cl
+
+    root_p = [None] * Nstates
+
+    # weight by the data itself: only a sum of terms if the fixed state's cl
+    #   is 0 (otherwise like = (cl_free^2 + 1) / (cl_free + 1))
+    if root_prior == "condlike":
+        if cl_fixed != 0:
+            return None
+        root_p[free] = 1.
+        root_p[which_fixed] = 0.
+
+    # stationary distribution: all weight on the state that can't be left
+    elif root_prior == "stationary":
+        root_p[free] = 0.
+        root_p[which_fixed] = 1.
+
+    elif root_prior == "uniform":
+        root_p = [1./Nstates] * Nstates
+
+    elif type(root_prior) == list and len(root_prior) == Nstates:
+        root_p = [ float(p) for p in root_prior ]
+
+    else:
+        return None
+
+    ### integrate each term against the prior
+
+    terms = root_p[free] * coefs * prior_rate / (prior_rate + exps)
+    marg = root_p[which_fixed] * cl_fixed + np.sum(terms)
+
+    # nothing left means the states are impossible under this model
+    if marg == 0 and not np.any(terms):
+        return -np.inf
+
+    # terms of both signs can cancel: give up if too many digits are lost
+    #   (relative error is about max_cond * machine epsilon)
+    if marg <= 0 or \
+       (root_p[which_fixed] * cl_fixed + np.sum(np.abs(terms))) / marg > max_cond:
+        return None
+
+    return np.log(marg)
+
+#--------------------------------------------------
+# Functions for the guts of the expansion
+#--------------------------------------------------
+
+def _GetTreePoly(node, which_fixed, time_slice, max_terms):
+    '''
+    Get the cl's for a node: the free-state cl as (exponents, coefficients)
+      of its terms, and the fixed-state cl (0 or 1).
+    Returns None if a product would have more than max_terms terms (before
+      merging equal exponents).
+    '''
+
+    free = 1 - which_fixed
+
+    ### if it's a tip, the cl's are determined by the observed state
+    if node.daughters == None:
+        if node.state == free:
+            return (np.zeros(1), np.ones(1)), 0
+        elif node.state == which_fixed:
+            return (np.zeros(0), np.zeros(0)), 1
+        else:
+            print("ERROR: Tip state not specified.  Aborting in Mk2Exact...")
+            sys.exit()
+
+    ### otherwise, multiply together the daughters' contributions
+    poly = (np.zeros(1), np.ones(1))
+    cl_fixed = 1
+
+    for d in node.daughters:
+        ans = _GetTreePoly(d, which_fixed, time_slice, max_terms)
+        if ans == None:
+            return None
+        ((exps, coefs), d_fixed) = ans
+
+        # free-state parent: e * (daughter free cl) + (1 - e) * (daughter fixed cl)
+        t = Mk2Like._BranchLength(d, time_slice)
+        #   (with no time in the slice, e = 1 and the branch changes nothing)
+        factor = (exps + t, coefs)
+        if d_fixed != 0 and t > 0:
+            factor = (np.append(factor[0], [0, t]), \
+                      np.append(factor[1], [d_fixed, -d_fixed]))
+
+        # check the size before forming the product, not after: the outer
+        #   product of two big sums is what costs the time and memory
+        if len(poly[0]) * len(factor[0]) > max_terms:
+            return None
+        poly = _Multiply(poly, factor)
+
+        # fixed-state parent can only have fixed-state daughters
+        cl_fixed *= d_fixed
+
+    return poly, cl_fixed
+
+def _Multiply(a, b):
+    '''
+    Multiply two sums of exponential terms, merging terms whose exponents
+      coincide (to rounding error).
+    '''
+
+    exps = np.add.outer(a[0], b[0]).ravel()
+    coefs = np.multiply.outer(a[1], b[1]).ravel()
+
+    return _Merge(exps, coefs)
+
+def _Merge(exps, coefs):
+    keys = np.round(exps, 10)
+    (unique, index) = np.unique(keys, return_inverse=True)
+    merged = np.bincount(index.reshape(-1), weights=coefs, minlength=len(unique))
+    keep = merged != 0
+    return unique[keep], merged[keep]
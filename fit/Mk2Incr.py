@@ -0,0 +1,138 @@
+import sys
+import numpy as np
+from scipy.special import logsumexp
+
+from TreeStruct import TreeNode, Nstates
+import TreeExtra
+import Mk2Like
+
+class IncrementalLike:
+    '''
+        IncrementalLike keeps the conditional likelihoods of every node in a
+        tree, for a fixed set of rate values (one column each), so that after
+        a tip state is changed, a branch length is edited or a tip is added,
+        only the nodes from there to the root are recomputed.
+           root: the tree (it is changed by the Set/Insert methods)
+           rates: (rates[0], rates[1]) arrays, with one column per rate setting
+           log_weights: log quadrature weight of each column, for LogMargLik
+              (e.g. from RateGrid), or None if only LogLike is wanted
+           time_slice, root_prior: as in Mk2Like.NegLogL
+           work: the workspace of (cl, lq) for every node, as in Mk2Like
+    '''
+    def __init__(self, root, rates, log_weights=None, time_slice=None, \
+                 root_prior="condlike"):
+        self.root = root
+        self.rates = (np.asarray(rates[0], dtype=float), \
+                      np.asarray(rates[1], dtype=float))
+        self.log_weights = log_weights
+        self.time_slice = time_slice
+        self.root_prior = root_prior
+        self._nodenum = TreeExtra.CountNodes(root)
+
+        self.work = {}
+        Mk2Like._GetTreeCLsBatch(root, self._TipCL, self._BranchProbs, \
+                                 self.work)
+
+    def LogLike(self):
+        ''' returns the log-likelihood for each column of rates '''
+        (cl, lq) = self.work[self.root]
+        loglike = Mk2Like._CombineAtRootBatch(self.rates, cl, lq, \
+                                              self.root_prior)
+        # 0/0 in log-compensation means the likelihood is 0
+        return np.where(np.isnan(loglike), -np.inf, loglike)
+
+    def LogMargLik(self):
+        ''' returns the log marginal likelihood, summed over the columns '''
+        if self.log_weights is None:
+            raise ValueError("IncrementalLike needs log_weights for LogMargLik")
+        return logsumexp(self.LogLike() + self.log_weights)
+
+    def SetTipState(self, tip, state):
+        ''' change the state of a tip '''
+        tip.state = state
+        self.work[tip] = (self._TipCL(tip), 0)
+        self._UpdatePath(tip.parent)
+
+    def SetBranchLength(self, node, length):
+        '''
+        Change the length of the branch above node.
+        If the tree has node times, the times of node and everything below it
+          move with it; with a time slice, that subtree is then recomputed too.
+        '''
+        node.length = length
+        if node.time != None and node.parent != None:
+            TreeExtra.AssignNodeTimes(node)
+            if self.time_slice != None:
+                Mk2Like._GetTreeCLsBatch(node, self._TipCL, \
+                                         self._BranchProbs, self.work)
+        self._UpdatePath(node.parent)
+
+    def InsertTip(self, node, label, state, above, length):
+        '''
+        Add a tip, joined to the branch above node at distance "above" from
+          node, on a new branch of the given length.
+        Returns the new tip (or None if it can't be joined there).
+        '''
+
+        if node.parent == None or not 0 <= above <= node.length:
+            print("ERROR: can't join a tip %f above node %s" % (above, node.label))
+            return None
+
+        # new internal node on the branch above node
+        self._nodenum += 1
+        parent = node.parent
+        new = TreeNode(label="n%d" % self._nodenum, length=node.length - above, \
+                       parent=parent)
+        parent.daughters[parent.daughters.index(node)] = new
+        node.parent = new
+        node.length = above
+
+        tip = TreeNode(label=label, length=length, state=state, parent=new)
+        new.daughters = [node, tip]
+
+        if node.time != None:
+            new.time = node.time - above
+            tip.time = new.time + length
+
+        self.work[tip] = (self._TipCL(tip), 0)
+        self._UpdatePath(new)
+
+        return tip
+
+    #--------------------------------------------------
+    # Helper functions
+    #--------------------------------------------------
+
+    def _UpdatePath(self, node):
+        ''' recompute the cl's from node up to the root '''
+        while node != None:
+            Mk2Like._ComputeCLBatch(node, self._BranchProbs, self.work)
+            node = node.parent
+
+    def _TipCL(self, tip):
+        # (cl[None] = 1 would silently set every state)
+        if tip.state not in range(Nstates):
+            print("ERROR: Tip state not specified.  Aborting in Mk2Incr...")
+            sys.exit()
+        cl = np.zeros((Nstates, 1))
+        cl[tip.state] = 1
+        return cl
+
+    def _BranchProbs(self, node):
+        t = Mk2Like._BranchLength(node, self.time_slice)
+        return Mk2Like._TransitionProbs(t, self.rates)
+
+def RateGrid(which_fixed, prior_rate, npoints=128):
+    '''
+    Get rate columns and log weights for the marginal likelihood of the model
+      with the rate which_fixed set to 0 and an exponential prior on the other.
+    (The rule is Mk2Like.LogRateRule.)
+    '''
+
+    (q, log_weights) = Mk2Like.LogRateRule(prior_rate, npoints)
+
+    rates = [q, np.zeros(npoints)]
+    if which_fixed == 0:
+        rates.reverse()
+
+    return rates, log_weights
@@ -20,89 +20,183 @@ def NegLogL(var_rates, root, root_prior, rate_arrange, \
             return np.inf
 
     # If some rates are being fixed, arrange them
-    if rate_arrange == "fix":
-        rates = list(var_rates)
-        rates.insert(which_fixed, fixed_rate)
-        rates = np.array(rates)
-    elif rate_arrange == "equal":
-        rates = list(var_rates) * Nstates
-        rates = np.array(rates)
-    else:
-        rates = var_rates
+    rates = _ArrangeRates(var_rates, rate_arrange, fixed_rate, which_fixed)
 
     # Assign conditional likelihoods to each node in the tree
-    if time_slice == None:
-        _GetTreeCLs(root, rates)
-    else:
-        _GetTreeCLsSlice(root, rates, time_slice)
+    #  (kept in a workspace for this call, so the tree is only read)
+    work = {}
+    _GetTreeCLs(root, rates, time_slice, work)
 
     # Compute the likelihood by combining the cl's at the root.
-    loglike = _CombineAtRoot(rates, root, root_prior)
+    (cl, lq) = work[root]
+    loglike = _CombineAtRoot(rates, cl, lq, root_prior)
 
     return -loglike
 
-#--------------------------------------------------
-# Functions for the guts of the likelihood calculation
-#-------------------------------------------------- 
-
-def _GetTreeCLs(node, rates):
+def NegLogLPatterns(var_rates, root, labels, patterns, root_prior, \
+                    rate_arrange, fixed_rate, which_fixed, time_slice):
     '''
-    Get the conditional likelihoods (likelihood of being in each state)
-      for each node in the tree.
+    Like NegLogL, but for many tip-state patterns on the same tree at once,
+      all computed in a single traversal of the tree.
+    patterns has one row per tip (in the order of labels) and one column per
+      replicate; the tip states stored in the tree are not used.
+    Identical patterns are only computed once.
+    Returns an array with the negative log-likelihood of each column.
     '''
 
-    ### get somewhere in the tree
-    if node.daughters != None:
-        for d in node.daughters:
-            _GetTreeCLs(d, rates)
+    patterns = np.asarray(patterns)
 
-    ### compute the cl for this node
+    # Can't have negative rate values.
+    for r in var_rates:
+        if r < 0:
+            return np.full(patterns.shape[1], np.inf)
 
-    # if it's a tip, the cl's are determined by the observed state
-    if node.daughters == None:
+    rates = _ArrangeRates(var_rates, rate_arrange, fixed_rate, which_fixed)
+
+    # Only compute each distinct pattern once
+    unique, weights, index = CompressPatterns(patterns)
+    tip_rows = dict(zip(labels, range(len(labels))))
+
+    def tip_cl(tip):
         try:
-            for i in range(Nstates):
-                node.cl[i] = 0
-            node.cl[node.state] = 1
-        except TypeError:
+            row = unique[tip_rows[tip.label]]
+        except KeyError:
+            print("ERROR: Tip %s not in the patterns.  Aborting in Mk2Like..." \
+                  % (tip.label))
+            sys.exit()
+        return (row == np.arange(Nstates)[:,None]).astype(float)
+
+    def branch_probs(node):
+        return _TransitionProbs(_BranchLength(node, time_slice), rates)[:,:,None]
+
+    # Get the conditional likelihoods of every pattern at the root
+    work = {}
+    _GetTreeCLsBatch(root, tip_cl, branch_probs, work)
+    (cl, lq) = work[root]
+
+    loglike = _CombineAtRootBatch(rates, cl, lq, root_prior)
+
+    return -loglike[index]
+
+def LogLRateGrid(q0, q1, root, root_prior, time_slice):
+    '''
+    Get the log-likelihood of the tree and states for every pair of rates
+      (q0[i], q1[j]) on a grid, all in a single traversal of the tree.
+    For each branch, exp(-q*t) is only computed once per rate value, and the
+      grid of exp(-(q0+q1)*t) is made from their products.
+    Returns an array of shape (len(q0), len(q1)).
+    '''
+
+    q0 = np.asarray(q0, dtype=float)
+    q1 = np.asarray(q1, dtype=float)
+    rates = (np.repeat(q0, len(q1)), np.tile(q1, len(q0))) # flattened grid
+
+    def tip_cl(tip):
+        # (cl[None] = 1 would silently set every state)
+        if tip.state not in range(Nstates):
             print("ERROR: Tip state not specified.  Aborting in Mk2Like...")
             sys.exit()
+        cl = np.zeros((Nstates, 1))
+        cl[tip.state] = 1
+        return cl
 
-    # otherwise, the cl's are computed from the cl's of the daughters
+    def branch_probs(node):
+        t = _BranchLength(node, time_slice)
+        decay = np.outer(np.exp(-q0 * t), np.exp(-q1 * t)).ravel()
+        return _TransitionProbs(t, rates, decay)
+
+    work = {}
+    _GetTreeCLsBatch(root, tip_cl, branch_probs, work)
+    (cl, lq) = work[root]
+
+    loglike = _CombineAtRootBatch(rates, cl, lq, root_prior)
+
+    return loglike.reshape(len(q0), len(q1))
+
+def LogRateRule(prior_rate, npoints):
+    '''
+    Get rate values and log weights for integrating over an exponential prior
+      on a rate (mean 1/prior_rate), by the trapezoid rule in log(rate), which
+      handles likelihoods that peak at very small or very large rates.
+    Integral of like(q) * prior(q) ~= sum(exp(loglike(rates) + log_weights))
+    Returns rates, log_weights (arrays of length npoints).
+    '''
+
+    s = np.linspace(-20, 4, npoints)
+    rates = np.exp(s) / prior_rate
+    width = np.full(npoints, s[1] - s[0])
+    width[[0, -1]] /= 2
+    log_weights = np.log(prior_rate) - rates * prior_rate + np.log(rates) + \
+                  np.log(width)
+
+    return rates, log_weights
+
+def CompressPatterns(patterns):
+    '''
+    Collapse identical columns of a tip-state pattern matrix.
+    Returns the distinct patterns (one per column), the number of times each
+      one occurs, and the index of the distinct pattern for each original
+      column.
+    (Total log-likelihood of all columns = sum(weights * loglike of distinct))
+    '''
+
+    (unique, index, weights) = np.unique(patterns, axis=1, \
+            return_inverse=True, return_counts=True)
+
+    return unique, weights, index.reshape(-1)
+
+#--------------------------------------------------
+# Functions for the guts of the likelihood calculation
+#-------------------------------------------------- 
+
+def _ArrangeRates(var_rates, rate_arrange, fixed_rate, which_fixed):
+    '''
+    Put the free and fixed rates together into the full vector of rates.
+    '''
+
+    if rate_arrange == "fix":
+        rates = list(var_rates)
+        rates.insert(which_fixed, fixed_rate)
+        rates = np.array(rates)
+    elif rate_arrange == "equal":
+        rates = list(var_rates) * Nstates
+        rates = np.array(rates)
     else:
-        _ComputeCL(node, rates)
+        rates = var_rates
+
+    return rates
 
-def _GetTreeCLsSlice(node, rates, time_slice):
+def _GetTreeCLs(node, rates, time_slice, work):
     '''
     Get the conditional likelihoods (likelihood of being in each state)
-      for each node in the tree, for the special case of transitions allowed
-      only within time_slice.
+      for each node in the tree.
+    If time_slice is given, transitions are only allowed within it.
+    The results go in the workspace dictionary, as work[node] = (cl, lq);
+      the tree itself is not changed.
     '''
 
     ### get somewhere in the tree
     if node.daughters != None:
         for d in node.daughters:
-            _GetTreeCLsSlice(d, rates, time_slice)
+            _GetTreeCLs(d, rates, time_slice, work)
+
+    ### compute the cl for this node
 
-    ### if it's a tip, the cl's are the observed state
+    # if it's a tip, the cl's are determined by the observed state
     if node.daughters == None:
         try:
-            for i in range(Nstates):
-                node.cl[i] = 0
-            node.cl[node.state] = 1
+            cl = [0] * Nstates
+            cl[node.state] = 1
         except TypeError:
             print("ERROR: Tip state not specified.  Aborting in Mk2Like...")
             sys.exit()
+        work[node] = (cl, 0)
 
-    ### if the node is outside the time slice, don't allow transitions
-    elif node.time < time_slice[0] or node.time >= time_slice[1]:
-        _ComputeCL(node, (0, 0))
-
-    ### otherwise, allow transitions normally
+    # otherwise, the cl's are computed from the cl's of the daughters
     else:
-        _ComputeCL(node, rates)
+        _ComputeCL(node, rates, time_slice, work)
 
-def _ComputeCL(node, rates):
+def _ComputeCL(node, rates, time_slice, work):
     '''
     Get the conditional likelihood for a node, computed from the cl's of 
       its daughters.
@@ -112,7 +206,7 @@ def _ComputeCL(node, rates):
     #  from daughter state to parent state.
     # Multiply the daughter probabilities together, applying log-compensation.
     # Note: Because of log-comp, the cl value at a node is not its full CL.
-    #       log(node's full CL) = log(node.cl) + node.lq
+    #       log(node's full CL) = log(cl) + lq
     #       But cl is still on the regular, not-log scale.
 
     CLresults = [None] * len(node.daughters)
@@ -120,6 +214,8 @@ def _ComputeCL(node, rates):
     # each element will have length Nstates, for the possible parent states
 
     for i_d, d in enumerate(node.daughters):
+        (d_cl, d_lq) = work[d]
+        d_length = _BranchLength(d, time_slice)
         # compute the value for the parent state (s) considering all possible
         #   states of the daughter (s_d)
         cl_temp = [None] * Nstates
@@ -127,8 +223,8 @@ def _ComputeCL(node, rates):
             d_sum = 0
             for s_d in range(Nstates):
                 # transition prob from daughter state (s_d) to parent state (s)
-                #   (d.cl already indicates if daughter state is fixed)
-                d_sum += _TransitionProb(s, s_d, d.length, rates) * d.cl[s_d]
+                #   (d_cl already indicates if daughter state is fixed)
+                d_sum += _TransitionProb(s, s_d, d_length, rates) * d_cl[s_d]
             cl_temp[s] = d_sum
         CLresults[i_d] = cl_temp
 
@@ -147,15 +243,79 @@ def _ComputeCL(node, rates):
             #   of each daughter node's lq (branch inits)
             lq = np.sum(np.log(q))
         for d in node.daughters:
-            lq += d.lq
-        node.lq = lq
+            lq += work[d][1]
 
         # cl[i] for the node contains the product of the daughter cl[i]'s
-        node.cl = np.prod(CLresults, axis=0).tolist()
+        work[node] = (np.prod(CLresults, axis=0).tolist(), lq)
+
+    else:
+        work[node] = (CLresults[0], work[node.daughters[0]][1])
+
+def _BranchLength(node, time_slice):
+    '''
+    Get the length of the branch above node over which transitions can happen:
+      the whole branch, or just the part of it within time_slice.
+    (Same as inserting nodes at the slice edges, without changing the tree.)
+    '''
+
+    if time_slice == None:
+        return node.length
+
+    start = max(node.parent.time, time_slice[0])
+    stop = min(node.time, time_slice[1])
+
+    return max(stop - start, 0)
 
+def _GetTreeCLsBatch(node, tip_cl, branch_probs, work):
+    '''
+    Get the conditional likelihoods for each node in the tree, for many
+      columns at once (tip-state patterns, rate values, or both).
+    tip_cl(tip) gives the cl's of a tip, with shape (Nstates, columns), and
+      branch_probs(node) gives the transition probabilities P[s, s_d, column]
+      along the branch above node (either may have a single column, which is
+      then shared by all columns).
+    The results go in the workspace dictionary, as work[node] = (cl, lq), with
+      the same log-compensation as _ComputeCL.
+    '''
+
+    ### if it's a tip, the cl's are the observed states
+    if node.daughters == None:
+        work[node] = (tip_cl(node), 0)
+        return
+
+    ### get somewhere in the tree
+    for d in node.daughters:
+        _GetTreeCLsBatch(d, tip_cl, branch_probs, work)
+
+    _ComputeCLBatch(node, branch_probs, work)
+
+def _ComputeCLBatch(node, branch_probs, work):
+    '''
+    Get the conditional likelihoods for a node, for all columns, computed from
+      the cl's of its daughters (as in _ComputeCL).
+    '''
+
+    CLresults = [None] * len(node.daughters)
+    lq = 0
+    for i_d, d in enumerate(node.daughters):
+        (d_cl, d_lq) = work[d]
+        # P[s, s_d] = transition prob from daughter state to parent state
+        P = branch_probs(d)
+        CLresults[i_d] = np.sum(P * d_cl[None,:,:], axis=1)
+        lq = lq + d_lq
+
+    # If it's a true node (not a dummy), do log-compensation
+    if len(node.daughters) > 1:
+        CLresults = np.array(np.broadcast_arrays(*CLresults))
+        q = np.sum(CLresults, axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            CLresults = CLresults / q[:,None,:]
+            lq = lq + np.sum(np.log(q), axis=0)
+        cl = np.prod(CLresults, axis=0)
     else:
-        node.cl = CLresults[0]
-        node.lq = node.daughters[0].lq
+        cl = CLresults[0]
+
+    work[node] = (cl, lq)
 
 def _TransitionProb(to_state, from_state, time, rates):
     '''
@@ -175,7 +335,39 @@ def _TransitionProb(to_state, from_state, time, rates):
 
     return ans
 
-def _CombineAtRoot(rates, root, root_prior, separate=False):
+def _TransitionProbs(times, rates, decay=None):
+    '''
+    Vectorized version of _TransitionProb, for many branches at once.
+    times and each of the rates may be scalars or arrays (they are broadcast).
+    (decay = exp(-(rates[0]+rates[1])*times) can be passed in if already known)
+    Returns an array P with P[to_state, from_state] holding the transition
+      probabilities for every broadcast element.
+    Currently, only valid for Nstates = 2.
+    '''
+
+    times = np.asarray(times, dtype=float)
+    r = [np.asarray(rates[0], dtype=float), np.asarray(rates[1], dtype=float)]
+    total = r[0] + r[1]
+    shape = np.broadcast(times, r[0], r[1]).shape
+
+    # no transitions possible if all rates are zero or the branch has no length
+    still = np.broadcast_to((total == 0) | (times == 0), shape)
+
+    P = np.empty((Nstates, Nstates) + shape)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        if decay is None:
+            decay = np.exp(-total * times)
+        for to_state in range(Nstates):
+            for from_state in range(Nstates):
+                ans = ( r[(from_state+1)%2] + pow(-1, to_state-from_state) * \
+                        (r[to_state] * decay) \
+                       ) / total
+                P[to_state, from_state] = np.where(still, \
+                        float(to_state == from_state), ans)
+
+    return P
+
+def _CombineAtRoot(rates, cl, lq, root_prior, separate=False):
     '''
     Invoke the assumption about the root prior here.
     Log-compensation is restored.
@@ -183,7 +375,7 @@ def _CombineAtRoot(rates, root, root_prior, separate=False):
        state (separate=True)
     '''
 
-    like = root.cl.copy()
+    like = list(cl)
 
     ### calculate the appropriate weights for each root state
 
@@ -203,7 +395,7 @@ def _CombineAtRoot(rates, root, root_prior, separate=False):
     elif root_prior == "condlike":
         for i in range(Nstates):
             try:
-                root_p[i] = root.cl[i] / sum(root.cl)
+                root_p[i] = cl[i] / sum(cl)
             except ZeroDivisionError:
                 root_p[i] = 0
                 # then later get like = 0 and return -inf
@@ -226,13 +418,57 @@ def _CombineAtRoot(rates, root, root_prior, separate=False):
         ans = [-np.inf] * Nstates
         for i, x in enumerate(like):
             try:
-                ans[i] = log(x) + root.lq
+                ans[i] = log(x) + lq
             except ValueError:
                 pass
     else:
         try:
-            ans = log(sum(like)) + root.lq
+            ans = log(sum(like)) + lq
         except ValueError:
             ans = -np.inf
 
     return ans
+
+def _CombineAtRootBatch(rates, cl, lq, root_prior):
+    '''
+    Vectorized _CombineAtRoot, for root cl's with many columns (the rates may
+      also be arrays with one value per column).
+    Returns an array with the total log-likelihood of each column.
+    '''
+
+    ### calculate the appropriate weights for each root state
+
+    # stationary distribution
+    if root_prior == "stationary":
+        assert Nstates == 2
+        root_p = np.array([rates[1] / sum(rates), rates[0] / sum(rates)])
+
+    # equal weights for each state
+    elif root_prior == "uniform":
+        root_p = np.full(Nstates, 1./Nstates)
+
+    # weight by the data itself
+    elif root_prior == "condlike":
+        total = np.sum(cl, axis=0)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            root_p = np.where(total > 0, cl / total, 0)
+            # then later get like = 0 and return -inf
+
+    # arbitrary root prior
+    elif type(root_prior) == list and len(root_prior) == Nstates:
+        root_p = np.array([ float(p) for p in root_prior ])
+
+    else:
+        print("ERROR: invalid root_prior specified.")
+        sys.exit()        # more graceful exit?
+
+    if root_p.ndim == 1:
+        root_p = root_p[:,None]
+
+    ### return the log-likelihoods
+
+    like = np.sum(cl * root_p, axis=0)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        ans = np.where(like > 0, np.log(like), -np.inf) + lq
+
+    return ans
@@ -0,0 +1,127 @@
+import sys
+import numpy as np
+
+from TreeStruct import Nstates
+import Mk2Like
+
+def SimulateTipStates(root, rates, nreps, root_prior="stationary", \
+                      time_slice=None, rng=None):
+    '''
+    Simulate nreps replicate character histories on the tree under the Mk2
+      model, and return the tip labels and the simulated tip states.
+    The states are an integer array with one row per tip (in the order of the
+      returned labels) and one column per replicate.
+    All replicates are drawn together, one level of the tree at a time, using
+      the same transition probabilities as the likelihood calculation.
+    If time_slice is given, transitions are only allowed within the slice
+      (as in Mk2Like); the tree itself is not changed.
+    rng can be a numpy Generator or a seed.
+    '''
+
+    rng = np.random.default_rng(rng)
+    nodes, parents, levels = _LevelOrder(root)
+
+    states = np.empty((len(nodes), nreps), dtype=int)
+
+    ### draw the root state
+
+    root_p = _RootProbs(rates, root_prior)
+    states[0] = rng.random(nreps) < root_p[1]
+
+    ### work down the tree, one level at a time
+
+    for (start, stop) in levels:
+
+        level_nodes = nodes[start:stop]
+        times = np.array([Mk2Like._BranchLength(n, time_slice) \
+                          for n in level_nodes], dtype=float)
+
+        # P[parent state, daughter state] for each node on this level
+        P = Mk2Like._TransitionProbs(times, rates)
+
+        # probability of a daughter being in state 1, given its parent's state
+        parent_states = states[parents[start:stop]]
+        p1 = np.where(parent_states == 1, P[1,1][:,None], P[0,1][:,None])
+        states[start:stop] = rng.random((stop-start, nreps)) < p1
+
+    ### keep just the tips
+
+    tips = [i for i, n in enumerate(nodes) if n.daughters == None]
+    labels = [nodes[i].label for i in tips]
+
+    return labels, states[tips]
+
+def PutTipStates(root, labels, states):
+    '''
+    Give tips their states from one simulated replicate, so the tree can go
+      straight to the likelihood calculation.
+    labels and states are in the same order (e.g. one column of the output of
+      SimulateTipStates).
+    '''
+
+    state_dict = dict(zip(labels, states))
+    _PutTipStatesGuts(root, state_dict)
+
+def _PutTipStatesGuts(node, state_dict):
+    if node.daughters == None:
+        node.state = int(state_dict[node.label])
+    else:
+        for d in node.daughters:
+            _PutTipStatesGuts(d, state_dict)
+
+#--------------------------------------------------
+# Helper functions
+#--------------------------------------------------
+
+def _LevelOrder(root):
+    '''
+    List the nodes in level (breadth-first) order.
+    Returns the nodes, the index of each node's parent in that list, and the
+      (start, stop) indices of each level below the root.
+    '''
+
+    nodes = [root]
+    parents = [-1]
+    levels = []
+
+    start = 0
+    while start < len(nodes):
+        stop = len(nodes)
+        for i in range(start, stop):
+            if nodes[i].daughters != None:
+                for d in nodes[i].daughters:
+                    nodes.append(d)
+                    parents.append(i)
+        if len(nodes) > stop:
+            levels.append((stop, len(nodes)))
+        start = stop
+
+    return nodes, np.array(parents), levels
+
+def _RootProbs(rates, root_prior):
+    '''
+    Get the probability of each root state for the simulation.
+    '''
+
+    # stationary distribution
+    if root_prior == "stationary":
+        assert Nstates == 2
+        if sum(rates) == 0:
+            print("ERROR: stationary root prior needs a nonzero rate.")
+            sys.exit()
+        root_p = [rates[1] / sum(rates)]
+        root_p.append(1 - root_p[0])
+
+    # equal weights for each state
+    elif root_prior == "uniform":
+        root_p = [1./Nstates] * Nstates
+
+    # arbitrary root prior
+    elif type(root_prior) == list and len(root_prior) == Nstates:
+        root_p = [ float(p) for p in root_prior ]
+
+    else:
+        print("ERROR: invalid root_prior specified for simulation.")
+        sys.exit()
+
+    return root_p
@@ -57,6 +57,18 @@ def GetTipDistances(node, distances):
 
 ######################################################
 
+def CountNodes(node):
+    '''
+    Count the nodes (including tips) at and below node.
+    '''
+
+    count = 1
+    if node.daughters != None:
+        for d in node.daughters:
+            count += CountNodes(d)
+
+    return count
+
 def InsertNodesSlice(root, time):
     '''
     Along each branch that spans "time", insert a node at "time".
@@ -74,13 +86,15 @@ def InsertNodesSlice(root, time):
 
     # then, insert the new nodes
     # (note: inserting nodes while traversing the tree causes trouble)
+    # (new labels are numbered on from the size of this tree, not a global count)
 
     new_nodes = []
+    nodenum = CountNodes(root)
 
     for node in branch_list:
 
-        TreeStruct._nodenum += 1
-        new = TreeStruct.TreeNode(label = "n%d" % TreeStruct._nodenum, time=time, parent=node.parent)
+        nodenum += 1
+        new = TreeStruct.TreeNode(label = "n%d" % nodenum, time=time, parent=node.parent)
         node.parent = new
 
         new.daughters = [node]
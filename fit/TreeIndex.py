@@ -0,0 +1,168 @@
+import numpy as np
+
+class TreeIndex:
+    '''
+        TreeIndex holds precomputed lookups for a tree, so that node times,
+        ages and ancestor relationships can be found without walking the tree.
+        It is built in one pass over the tree (the Euler tour and sparse table
+        for MRCA queries are only built on the first MRCA call), and stays
+        valid as long as the tree's shape and times are not changed (e.g. by
+        TreeExtra.InsertNodesSlice); rebuild it if they are.
+           nodes: all nodes, in preorder (a node's position is its index)
+           parent: index of each node's parent (-1 for the root)
+           depth: distance from the root to each node
+           latest: greatest depth of any tip below each node
+           size: number of nodes in each node's subtree (including itself)
+           tips: the tips, in preorder
+           tip_range: [first, last+1) positions in tips for each node's subtree
+           euler, euler_level, first: Euler tour of the tree, the number of
+              edges from the root at each step, and each node's first step
+              (None until the first MRCA call)
+    '''
+    def __init__(self, root):
+        self.root = root
+        # use node times if given; otherwise, use branch lengths
+        self.timed = root.time != None
+
+        nodes = []
+        parent = []
+        depth = []
+        level = []
+        stack = [(root, -1, 0.0, 0)]
+        while stack:
+            (node, p, dep, lev) = stack.pop()
+            nodes.append(node)
+            parent.append(p)
+            if self.timed:
+                dep = node.time - root.time
+            depth.append(dep)
+            level.append(lev)
+            if node.daughters != None:
+                i = len(nodes) - 1
+                for d in reversed(node.daughters):
+                    stack.append((d, i, dep + (d.length or 0), lev + 1))
+
+        n = len(nodes)
+        self.nodes = nodes
+        self.index = { node: i for i, node in enumerate(nodes) }
+        self.parent = np.array(parent)
+        self.depth = np.array(depth, dtype=float)
+        self._level = np.array(level)
+
+        ### subtree sizes, tip ranges and latest tips (children come after
+        ###   their parents in preorder, so one backwards pass does it)
+
+        is_tip = np.array([node.daughters == None for node in nodes])
+        self.tips = [node for node in nodes if node.daughters == None]
+        tip_pos = np.cumsum(is_tip) - is_tip
+
+        self.size = np.ones(n, dtype=int)
+        self.latest = np.where(is_tip, self.depth, -np.inf)
+        ntips_below = is_tip.astype(int)
+        for i in range(n-1, 0, -1):
+            p = parent[i]
+            self.size[p] += self.size[i]
+            self.latest[p] = max(self.latest[p], self.latest[i])
+            ntips_below[p] += ntips_below[i]
+        self.tip_range = np.column_stack((tip_pos, tip_pos + ntips_below))
+
+        self.euler = None
+        self.euler_level = None
+        self.first = None
+        self._table = None
+
+    def Index(self, node):
+        ''' returns the position of a node in the index '''
+        return self.index[node]
+
+    def Time(self, node):
+        ''' returns the time (on the tree) of a node '''
+        if self.timed:
+            return self.root.time + self.depth[self.Index(node)]
+        return self.depth[self.Index(node)]
+
+    def LatestTipTime(self):
+        ''' returns the time of the latest-sampled tip '''
+        if self.timed:
+            return self.root.time + self.latest[0]
+        return self.latest[0]
+
+    def Age(self, node):
+        ''' returns the greatest distance between a node and any tip below it '''
+        i = self.Index(node)
+        return self.latest[i] - self.depth[i]
+
+    def TipAges(self):
+        ''' returns how long before the latest-sampled tip each tip was sampled '''
+        tip_depths = np.array([self.depth[self.Index(t)] for t in self.tips])
+        return self.latest[0] - tip_depths
+
+    def SubtreeTips(self, node):
+        ''' returns the tips below a node, in preorder '''
+        (first, last) = self.tip_range[self.Index(node)]
+        return self.tips[first:last]
+
+    def IsAncestor(self, anc, node):
+        ''' returns True if anc is node or one of its ancestors '''
+        i = self.Index(anc)
+        j = self.Index(node)
+        return i <= j < i + self.size[i]
+
+    def MRCA(self, a, b):
+        ''' returns the most recent common ancestor of two nodes '''
+        if self._table == None:
+            self._BuildEuler()
+        (i, j) = sorted((self.first[self.Index(a)], self.first[self.Index(b)]))
+        return self.nodes[self.euler[self._table.ArgMin(i, j)]]
+
+    def _BuildEuler(self):
+        ''' Euler tour and sparse table, for lowest common ancestors '''
+
+        first = np.zeros(len(self.nodes), dtype=int)
+        euler = [0]
+        stack = [(0, iter(self.nodes[0].daughters or []))]
+        while stack:
+            (i, kids) = stack[-1]
+            d = next(kids, None)
+            if d == None:
+                stack.pop()
+                if stack:
+                    euler.append(stack[-1][0])
+            else:
+                j = self.index[d]
+                first[j] = len(euler)
+                euler.append(j)
+                stack.append((j, iter(d.daughters or [])))
+
+        self.euler = np.array(euler)
+        self.euler_level = self._level[self.euler]
+        self.first = first
+        self._table = _SparseTable(self.euler_level)
+
+class _SparseTable:
+    '''
+        Sparse table for O(1) range-minimum queries on a fixed array.
+        table[k][i] is the position of the smallest value in values[i:i+2**k]
+    '''
+    def __init__(self, values):
+        self.values = values
+        m = len(values)
+        self.table = [np.arange(m)]
+        k = 1
+        while (1 << k) <= m:
+            prev = self.table[-1]
+            half = 1 << (k-1)
+            left = prev[:m - (1 << k) + 1]
+            right = prev[half:half + m - (1 << k) + 1]
+            self.table.append(np.where(values[left] <= values[right], \
+                                       left, right))
+            k += 1
+
+    def ArgMin(self, i, j):
+        ''' returns the position of the smallest value in values[i:j+1] '''
+        k = int(j - i + 1).bit_length() - 1
+        left = self.table[k][i]
+        right = self.table[k][j - (1 << k) + 1]
+        if self.values[left] <= self.values[right]:
+            return left
+        return right
@@ -1,8 +1,7 @@
 from io import StringIO
-import TreeExtra
+import TreeIndex
 
 Nstates = 2
-_nodenum = 1
 
 class TreeNode:
     '''
@@ -30,12 +29,13 @@ class TreeNode:
             self.length = self.time - self.parent.time
         else:
             self.length = length
-        self.cl = [0]*Nstates    # will hold conditional likelihood values
-        self.lq = 0              # will hold log-compensation for all branches above this node
         self.fixed = False       # will note if the node is fixed
 
-    def PrintNode(self):
-        ''' prints information about this node '''
+    def PrintNode(self, work=None):
+        '''
+        prints information about this node
+        (and its likelihood values, if given a workspace from Mk2Like)
+        '''
         print(self.label, end=" ")
         print(":", end=" ")
         if self.time != None:
@@ -44,10 +44,10 @@ class TreeNode:
             print("l = %2.4f," % (self.length), end=" ")
         if self.state != None:
             print("s = %s," % (str(self.state)), end=" ")
-        if self.cl != None:
-            print("cl = [%1.4f,%1.4f]," % (self.cl[0], self.cl[1]), end=" ")
-        if self.lq != None:
-            print("lq = %2.4f," % (self.lq), end=" ")
+        if work != None and self in work:
+            (cl, lq) = work[self]
+            print("cl = [%1.4f,%1.4f]," % (cl[0], cl[1]), end=" ")
+            print("lq = %2.4f," % (lq), end=" ")
         print("p =", end=" "),
         if self.parent != None:
             print(self.parent.label, end=" ")
@@ -61,13 +61,13 @@ class TreeNode:
             print("--", end=" ")
         print("")
 
-    def PrintTree(self, indent=2):
+    def PrintTree(self, indent=2, work=None):
         ''' prints a list of all descendants from this node '''
         print(" "*indent, end=" ")
-        self.PrintNode()
+        self.PrintNode(work)
         if self.daughters != None:
             for d in self.daughters:
-                d.PrintTree(indent+2)
+                d.PrintTree(indent+2, work)
 
     def NewickString(self, outparen=True):
         ''' returns all descendants from this node as a Newick string '''
@@ -112,10 +112,11 @@ class TreeNode:
             for d in self.daughters:
                 d._TipStatesGuts(tiplist)
 
-    def Age(self, ultrametric=False):
+    def Age(self, ultrametric=False, index=None):
         '''
-        returns the greatest distance between the root and any tip
+        returns the greatest distance between this node and any tip below it
         (take a shortcut if all tips are known to be the same age)
+        (pass a TreeIndex to reuse it; otherwise one is built for this node)
         '''
 
         if self.time == None:
@@ -128,8 +129,8 @@ class TreeNode:
                 node = node.daughters[0]
             max_time = node.time
         else:
-            distances = []
-            TreeExtra.GetTipDistances(self, distances)
-            max_time = max(distances)
+            if index == None:
+                index = TreeIndex.TreeIndex(self)
+            return index.Age(self)
 
         return abs(max_time - self.time)
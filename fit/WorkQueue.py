@@ -0,0 +1,172 @@
+import os, socket, threading, time
+
+class WorkQueue:
+    '''
+        WorkQueue lets any number of worker processes, on any machines that
+        share a filesystem, split up a fixed set of named tasks.
+           queue_dir: directory holding the queue (created if needed)
+              claims/<task>.lock: held while a worker is running the task
+              results/<task>: the task's result, written once it is done
+           stale: seconds without a heartbeat before a claim is taken over
+              (workers touch their lock files every stale/4 seconds)
+
+        Claims use exclusive file creation, which is atomic on shared
+        filesystems.  A stale claim is taken over by renaming its lock file
+        away; two workers can both judge the same lock stale, and the slower
+        one's rename might then catch the fresh lock the faster one just made,
+        so the renamed file is checked against the stale one and put back if
+        it isn't the same.  A worker only removes lock files that name it.
+        Results are written to a temporary file and renamed into place, so a
+        task that is run twice (e.g. by a worker that was only slow, not dead)
+        just rewrites the same result.
+        Stale claims are judged from lock file times, so the clocks of the
+        machines need to agree to well within "stale".
+    '''
+    def __init__(self, queue_dir, stale=600):
+        self.claim_dir = os.path.join(queue_dir, "claims")
+        self.result_dir = os.path.join(queue_dir, "results")
+        os.makedirs(self.claim_dir, exist_ok=True)
+        os.makedirs(self.result_dir, exist_ok=True)
+
+        self.stale = stale
+        self.worker = "%s.%d" % (socket.gethostname(), os.getpid())
+
+        self._held = set()
+        self._lock = threading.Lock()
+        self._heartbeat = None
+
+    def Done(self, task):
+        ''' returns True if the task has a result '''
+        return os.path.exists(self._ResultFile(task))
+
+    def Result(self, task):
+        ''' returns the task's result (None if it isn't done) '''
+        try:
+            with open(self._ResultFile(task), "r") as ifp:
+                return ifp.read()
+        except FileNotFoundError:
+            return None
+
+    def Claim(self, task):
+        '''
+        Try to claim a task for this worker.
+        Returns True if the claim succeeded, and False if the task is done or
+          is held by a live worker.
+        '''
+
+        if self.Done(task):
+            return False
+
+        lockfile = self._LockFile(task)
+        if not self._CreateLock(lockfile):
+            # someone else has it; take it over only if they've gone quiet
+            if not self._TakeOverStale(lockfile) or \
+               not self._CreateLock(lockfile):
+                return False
+
+        # it might have finished between the check above and the claim
+        if self.Done(task):
+            self.Release(task)
+            return False
+
+        with self._lock:
+            self._held.add(lockfile)
+        self._StartHeartbeat()
+        return True
+
+    def Finish(self, task, result):
+        ''' store the result of a claimed task and release the claim '''
+
+        resultfile = self._ResultFile(task)
+        tmpfile = resultfile + ".tmp." + self.worker
+        with open(tmpfile, "w") as ofp:
+            ofp.write(result)
+        os.replace(tmpfile, resultfile)
+
+        self.Release(task)
+
+    def Release(self, task):
+        ''' give up the claim on a task (e.g. after an error) '''
+
+        lockfile = self._LockFile(task)
+        with self._lock:
+            self._held.discard(lockfile)
+
+        # if the claim was taken over, the lock file is someone else's now
+        try:
+            with open(lockfile, "r") as ifp:
+                owner = ifp.read().strip()
+            if owner == self.worker:
+                os.remove(lockfile)
+        except FileNotFoundError:
+            pass
+
+    #--------------------------------------------------
+    # Helper functions
+    #--------------------------------------------------
+
+    def _LockFile(self, task):
+        return os.path.join(self.claim_dir, task + ".lock")
+
+    def _ResultFile(self, task):
+        return os.path.join(self.result_dir, task)
+
+    def _CreateLock(self, lockfile):
+        try:
+            fd = os.open(lockfile, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.write(fd, (self.worker + "\n").encode())
+        os.close(fd)
+        return True
+
+    def _TakeOverStale(self, lockfile):
+        '''
+        Remove a lock file that hasn't been touched for "stale" seconds.
+        Returns True if this worker removed it.
+        '''
+
+        try:
+            old = os.stat(lockfile)
+        except FileNotFoundError:
+            return True    # released in the meantime, so free to try again
+        if time.time() - old.st_mtime < self.stale:
+            return False
+
+        stalefile = lockfile + ".stale." + self.worker
+        try:
+            os.rename(lockfile, stalefile)
+        except FileNotFoundError:
+            return False
+
+        # between the stat and the rename, another worker may have taken the
+        #   lock over and made a fresh one (or the owner may have touched it):
+        #   if so, put it back and leave the task to them
+        new = os.stat(stalefile)
+        if (new.st_ino, new.st_mtime_ns) != (old.st_ino, old.st_mtime_ns):
+            try:
+                os.link(stalefile, lockfile)
+            except FileExistsError:
+                pass
+            os.remove(stalefile)
+            return False
+
+        os.remove(stalefile)
+        return True
+
+    def _StartHeartbeat(self):
+        if self._heartbeat == None:
+            self._heartbeat = threading.Thread(target=self._Beat, daemon=True)
+            self._heartbeat.start()
+
+    def _Beat(self):
+        ''' keep touching the held lock files, so they don't look stale '''
+        while True:
+            time.sleep(self.stale / 4.)
+            with self._lock:
+                held = list(self._held)
+            for lockfile in held:
+                try:
+                    os.utime(lockfile)
+                except FileNotFoundError:
+                    pass
@@ -6,12 +6,27 @@
 # Output: files of marginal likelihood values
 #         one file per tree, with time-homogeneous + all time slices
 #
-# No parallelization.  (Can run as an array job on a cluster.)
-
-import Newick, TreeExtra, Mk2Like
-import sys, os, glob
+# Optional second argument: number of threads for the time slices.
+# A last argument "bi" also gives the marginal likelihood with both rates free
+#   (direction "bi" in the output).
+# (Can also run as an array job on a cluster.)
+# The tree is only read by the likelihood, so slices can share it.
+#
+# Or, with second argument "queue", run as one of any number of workers
+#   (on any nodes sharing the filesystem) that split the (tree, slice) tasks
+#   between them through lock files in <dir>/mk2/queue/.  An optional third
+#   argument sets how many seconds a dead worker's claim lasts (default 600).
+#   Results in the queue are named by a hash of the tree file and the
+#   settings (prior_rate, bidirectional), so editing a tree or changing a
+#   setting reruns its tasks; old results are left in <dir>/mk2/queue/results/
+#   (safe to delete once no workers are running).
+
+import Newick, TreeExtra, TreeIndex, Mk2Like, Mk2Exact, WorkQueue
+import sys, os, glob, time, hashlib
 import numpy as np
 import scipy.integrate as integrate
+from scipy.special import logsumexp
+from concurrent.futures import ThreadPoolExecutor
 
 #--------------------------------------------------
 # Posterior = Likelihood * Prior
@@ -35,68 +50,174 @@ def post(q, root, which_fixed, time_slice, prior_rate):
     theta = [q]
     return np.exp(logprior(theta, prior_rate) + loglike(theta, root, which_fixed, time_slice))
 
-def runme(treefile):
+def marglik(root, which_fixed, time_slice, prior_rate):
+    # exact, if the likelihood expands into few enough well-conditioned terms
+    ans = Mk2Exact.LogMargLik(root, which_fixed, time_slice, prior_rate)
+    if ans != None:
+        return ans
+    ans = integrate.quad(post, 0, np.inf, \
+            args=(root, which_fixed, time_slice, prior_rate))
+    return np.log(ans[0])
+
+def marglik2d(root, time_slice, prior_rate, npoints=96):
+    # both rates free, each with the exponential prior
+    # tensor-product trapezoid rule in log(rate); all grid points come from
+    #   one batched likelihood traversal
+    (q, lw) = Mk2Like.LogRateRule(prior_rate, npoints)
+    ll = Mk2Like.LogLRateGrid(q, q, root, "condlike", time_slice)
+    ll[np.isnan(ll)] = -np.inf # 0/0 in log-compensation means likelihood 0
+    return logsumexp(ll + lw[:,None] + lw[None,:])
+
+#--------------------------------------------------
+# Tasks: time-homogeneous + each time slice
+#--------------------------------------------------
 
-    ### Get the tree ###
+prior_rate = 1 # reconsider if not one-month slices on few-year-old tree
+bidirectional = False # also fit both rates free (direction "bi"); set by "bi"
 
+def readtree(treefile):
     tree = Newick.ReadFromFileTTN(treefile)
     TreeExtra.AssignNodeTimes(tree)
+    return tree
 
-    prior_rate = 1 # reconsider if not one-month slices on few-year-old tree
-
-    outfile = os.path.join(os.path.dirname(treefile), "mk2",
-                           os.path.basename(treefile).rsplit(".", 1)[0] + "-mk2.csv")
-    with open(outfile, "w") as ofp:
-        ofp.write("slice,direction,marglik\n")
-
-    ### Time-homogeneous ###
-
-    ans01 = integrate.quad(post, 0, np.inf, args=(tree, 1, None, prior_rate))
-    ans10 = integrate.quad(post, 0, np.inf, args=(tree, 0, None, prior_rate))
-
-    with open(outfile, "a") as ofp:
-        ofp.write("ns,01," + str(np.log(ans01[0])) + "\n")
-        ofp.write("ns,10," + str(np.log(ans10[0])) + "\n")
-
-    print("done with time-homogeneous for", treefile)
-
-    ### Time slices ###
-
+def slicetasks(tree):
     # time increases from root to tips
     # root time might not be zero
 
     # first slice (slice 1) ends at the latest-sampled tip
     # slices work back from then in 1 month increments
-    tip_time = tree.time + tree.Age() # root time + max root-to-tip distance
+    index = TreeIndex.TreeIndex(tree) # the tree isn't changed, so build once
+    tip_time = index.LatestTipTime() # root time + max root-to-tip distance
     all_slice_times = np.arange(tip_time, tree.time, -1/12) # fixed slice size
     all_slice_times = np.append(all_slice_times, tree.time) # put in root time
     num_slices = len(all_slice_times) - 1
 
+    tasks = [("ns", None)] # time-homogeneous
     for n in range(num_slices):
-
         t_slice = [all_slice_times[n+1], all_slice_times[n]] # note the flip
-        tree = Newick.ReadFromFileTTN(treefile) # fresh copy, so slice can be inserted
-        TreeExtra.AssignNodeTimes(tree)
-        for t in t_slice:
-            TreeExtra.InsertNodesSlice(tree, t)
+        tasks.append(("s" + str(n+1).zfill(2), t_slice))
+    return tasks
+
+def runtask(tree, task):
+    # the likelihood handles the slice edges itself, so every task can
+    #   use the same (unchanged) tree
+    (s, t_slice) = task
+    ans01 = marglik(tree, 1, t_slice, prior_rate)
+    ans10 = marglik(tree, 0, t_slice, prior_rate)
+    lines = s + ",01," + str(ans01) + "\n" + s + ",10," + str(ans10) + "\n"
+    if bidirectional:
+        lines += s + ",bi," + str(marglik2d(tree, t_slice, prior_rate)) + "\n"
+    return lines
+
+def outname(treefile):
+    return os.path.join(os.path.dirname(treefile), "mk2",
+                        os.path.basename(treefile).rsplit(".", 1)[0] + "-mk2.csv")
 
-        ans01 = integrate.quad(post, 0, np.inf, args=(tree, 1, t_slice, prior_rate))
-        ans10 = integrate.quad(post, 0, np.inf, args=(tree, 0, t_slice, prior_rate))
+#--------------------------------------------------
+# Run one tree at a time
+#--------------------------------------------------
+
+def runme(treefile, nthreads=1):
+
+    tree = readtree(treefile)
+    tasks = slicetasks(tree)
+    num_slices = len(tasks) - 1
+
+    outfile = outname(treefile)
+    with open(outfile, "w") as ofp:
+        ofp.write("slice,direction,marglik\n")
 
-        s = "s" + str(n+1).zfill(2)
-        with open(outfile, "a") as ofp:
-            ofp.write(s + ",01," + str(np.log(ans01[0])) + "\n")
-            ofp.write(s + ",10," + str(np.log(ans10[0])) + "\n")
+    with ThreadPoolExecutor(max_workers=nthreads) as pool:
+        for n, lines in enumerate(pool.map(lambda t: runtask(tree, t), tasks)):
 
-        print("done with slice", n+1, "of", num_slices, "for", treefile)
+            with open(outfile, "a") as ofp:
+                ofp.write(lines)
+
+            if n == 0:
+                print("done with time-homogeneous for", treefile)
+            else:
+                print("done with slice", n, "of", num_slices, "for", treefile)
+
+#--------------------------------------------------
+# Run as one of many workers sharing a queue
+#--------------------------------------------------
+
+def taskprefix(treefile):
+    # results depend on the tree and the settings, so name them by both
+    name = os.path.basename(treefile).rsplit(".", 1)[0]
+    key = hashlib.sha1()
+    with open(treefile, "rb") as ifp:
+        key.update(ifp.read())
+    key.update(repr((prior_rate, bidirectional)).encode())
+    return name + "." + key.hexdigest()[:12]
+
+def runqueue(ttnfiles, queue_dir, stale):
+    '''
+    Claim and run (tree, slice) tasks until every task for every tree is done.
+    Any number of workers, on any nodes sharing the filesystem, can run this
+      at once on the same trees and queue_dir.
+    Each tree's output file is written (whole) once all its tasks are done.
+    '''
+
+    queue = WorkQueue.WorkQueue(queue_dir, stale)
+    trees = {}
+    remaining = list(ttnfiles)
+
+    while remaining:
+
+        waiting = False
+        for treefile in list(remaining):
+
+            if treefile not in trees:
+                tree = readtree(treefile)
+                trees[treefile] = (tree, slicetasks(tree), taskprefix(treefile))
+            (tree, tasks, name) = trees[treefile]
+
+            for task in tasks:
+                taskname = name + "." + task[0]
+                if queue.Claim(taskname):
+                    try:
+                        lines = runtask(tree, task)
+                    except BaseException:
+                        queue.Release(taskname)
+                        raise
+                    queue.Finish(taskname, lines)
+                    print("done with", task[0], "for", treefile)
+
+            results = [queue.Result(name + "." + task[0]) for task in tasks]
+            if None in results:
+                waiting = True # others are still working on this tree
+            else:
+                outfile = outname(treefile)
+                tmpfile = outfile + ".tmp." + queue.worker
+                with open(tmpfile, "w") as ofp:
+                    ofp.write("slice,direction,marglik\n")
+                    ofp.write("".join(results))
+                os.replace(tmpfile, outfile)
+                remaining.remove(treefile)
+                del trees[treefile]
+
+        # wait for the other workers (or for their claims to go stale)
+        if waiting:
+            time.sleep(min(stale / 4., 10))
 
 if __name__ == '__main__':
 
+    if sys.argv[-1] == "bi":
+        bidirectional = True
+        sys.argv.pop()
+
     wd = sys.argv[1]
     os.makedirs(os.path.join(wd, "mk2"), exist_ok=True)
 
     ttnfiles = glob.glob(wd + "*.ttn")
     ttnfiles.sort()
 
-    for ttn in ttnfiles:
-        runme(ttn)
+    if len(sys.argv) > 2 and sys.argv[2] == "queue":
+        stale = float(sys.argv[3]) if len(sys.argv) > 3 else 600
+        runqueue(ttnfiles, os.path.join(wd, "mk2", "queue"), stale)
+
+    else:
+        nthreads = int(sys.argv[2]) if len(sys.argv) > 2 else 1
+        for ttn in ttnfiles:
+            runme(ttn, nthreads)